@@ -0,0 +1,5 @@
+""" Synchronize custom JIRA field options through the CM4J context manager """
+
+from .client import JiraContextClient, OptionCache
+
+__all__ = ['JiraContextClient', 'OptionCache']
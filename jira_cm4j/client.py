@@ -0,0 +1,395 @@
+""" Client for the CM4J context manager endpoint of a custom JIRA field """
+
+import asyncio
+import logging
+import os
+import time
+from itertools import chain
+from pathlib import Path
+from typing import Callable
+
+import httpx
+import orjson
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_MANAGER_PATH = '/plugins/servlet/com.easesolutions.jira.plugins.contextmanager/projectadmin'
+
+# Upper bound on concurrent write requests issued against the context manager
+MAX_CONCURRENT_WRITES = 8
+
+# Responses to movePositions that are retried, with exponential backoff
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+RETRIES = 3
+BACKOFF_FACTOR = 0.3
+
+# Statuses answering a matching If-None-Match. POST requests get 412 rather than 304
+NOT_MODIFIED_STATUSES = frozenset([304, 412])
+
+# Option lists are kept here with their ETag so unchanged lists are not downloaded again
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'jira-field-sync-cm4j'
+
+def new_session(timeout: float = None) -> httpx.Client:
+    """Create a pooled HTTP/2 client that retries failed connections
+
+    No timeout is applied by default, since movePositions on a large field can be slow.
+    """
+    limits = httpx.Limits(max_keepalive_connections=16, max_connections=16)
+    transport = httpx.HTTPTransport(http2=True, limits=limits, retries=RETRIES)
+    return httpx.Client(transport=transport, timeout=timeout)
+
+def new_async_session(timeout: float = None) -> httpx.AsyncClient:
+    """Create the HTTP/2 client for a write batch, retrying failed connections"""
+    # Over HTTP/2 the writes are multiplexed as streams on one connection
+    limits = httpx.Limits(max_keepalive_connections=MAX_CONCURRENT_WRITES,
+                          max_connections=MAX_CONCURRENT_WRITES)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=RETRIES)
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+def is_error(res: httpx.Response):
+    """Check if error"""
+    try:
+        res.raise_for_status()
+    except httpx.HTTPStatusError as exc:
+        logger.critical("Requests error!")
+        logger.critical("URL: %s", res.request.url)
+        logger.critical("Body: %s", res.request.content)
+        logger.critical("Code: %s", res.status_code)
+        logger.critical("Response: %s", res.text)
+        raise exc
+
+def _values(response: httpx.Response) -> list:
+    """Parse the option list out of a context manager response"""
+    return orjson.loads(response.content)['data'][0]['context']['values']
+
+def diff_sorted(left: list, right: list) -> tuple:
+    """Split two sorted lists of unique values into the values only in left and only in right"""
+    only_left = []
+    only_right = []
+    i = j = 0
+    while i < len(left) and j < len(right):
+        if left[i] < right[j]:
+            only_left.append(left[i])
+            i += 1
+        elif left[i] > right[j]:
+            only_right.append(right[j])
+            j += 1
+        else:
+            i += 1
+            j += 1
+    only_left.extend(left[i:])
+    only_right.extend(right[j:])
+    return only_left, only_right
+
+def order_positions(options: list, static: list) -> dict:
+    """Number options alphabetically, followed by the static options in the given order"""
+    static_set = frozenset(static)
+    unsorted_opt_list = []
+    static_opts = {}
+    for opt in options:
+        if opt['value'] in static_set:
+            static_opts.setdefault(opt['value'], []).append(opt)
+        else:
+            unsorted_opt_list.append(opt)
+    sorted_opt_list = sorted(unsorted_opt_list, key=lambda opt: opt['value'].lower())
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Sorted option list: %s", [opt['value'] for opt in sorted_opt_list])
+
+    static_entries = chain.from_iterable(static_opts.get(opt, ()) for opt in static)
+    return {opt['optionId']: str(idx+1)
+            for idx, opt in enumerate(chain(sorted_opt_list, static_entries))}
+
+class OptionCache:
+    """Local copy of the field options, kept current as changes are applied"""
+
+    def __init__(self, path: Path = None):
+        self.values = []
+        self.by_value = {}
+        self._by_id = {}
+        self.path = path
+
+    def load(self, values: list):
+        """Replace the cached options with a fresh option list"""
+        self.values = []
+        self.by_value = {}
+        self._by_id = {}
+        self.merge(values)
+
+    def merge(self, values: list):
+        """Add options from an API response that are not cached yet
+
+        Several options may share a name, for instance a disabled copy next to an
+        enabled one. All of them are kept, and by_value points at the enabled copy.
+        """
+        for option in values or []:
+            if option['optionId'] in self._by_id:
+                continue
+            self.values.append(option)
+            self._by_id[option['optionId']] = option
+            current = self.get(option['value'])
+            if current is None or (current['disabled'] and not option['disabled']):
+                self.by_value[option['value']] = option['optionId']
+
+    def get(self, value: str):
+        """Retrieve the cached option with name value"""
+        return self._by_id.get(self.by_value.get(value))
+
+    def set_disabled(self, option_id: str, disabled: bool):
+        """Record a change to the disabled flag of an option"""
+        self._by_id[option_id]['disabled'] = disabled
+
+    def read_stored(self):
+        """Load the option list and ETag stored by a previous run, if any"""
+        if self.path is None:
+            return None
+        try:
+            stored = orjson.loads(self.path.read_bytes())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+        if not (isinstance(stored, dict) and isinstance(stored.get('etag'), str)
+                and isinstance(stored.get('values'), list)):
+            return None
+        return stored
+
+    def store(self, etag: str, values: list):
+        """Store the option list along with the ETag it was served with"""
+        if self.path is None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_bytes(orjson.dumps({'etag': etag, 'values': values}))
+        except OSError as exc:
+            logger.debug("Could not write option cache: %s", exc)
+
+class JiraContextClient:  # pylint: disable=too-many-instance-attributes
+    """Read and update the options of a CM4J custom field in one JIRA project"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, base_url: str, api_key: str, field_id: str, project_slug: str,
+                 *, session: httpx.Client = None,
+                 async_session_factory: Callable[[], httpx.AsyncClient] = new_async_session,
+                 dry_run: bool = False, conditional_fetch: bool = False):
+        """session serves the movePositions calls. Each write batch runs on a client
+        from async_session_factory, opened and closed within the batch. Neither client
+        is modified; the authorization header is sent with each request.
+
+        With conditional_fetch, the option list is stored under CACHE_DIR and
+        fetched again with If-None-Match, reusing the stored copy when unchanged.
+        """
+        self.url = base_url + CONTEXT_MANAGER_PATH
+        self.field_id = field_id
+        self.project_slug = project_slug
+        self.dry_run = dry_run
+        # Bodies are serialized with orjson, so the content type is set here
+        self.headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json',
+        }
+        self.session = session if session is not None else new_session()
+        self.async_session_factory = async_session_factory
+        self.cache = OptionCache(CACHE_DIR / f'{project_slug}-{field_id}.json'
+                                 if conditional_fetch else None)
+
+    def _params(self, op: str) -> dict:
+        return {
+            'op': op,
+            'projectKey': self.project_slug,
+        }
+
+    def _request(self, params: dict, json_data: dict, headers: dict = None) -> dict:
+        """Build the keyword arguments for a POST to the context manager"""
+        return {
+            'params': params,
+            'content': orjson.dumps(json_data),
+            'headers': {**self.headers, **(headers or {})},
+        }
+
+    def _send(self, params: dict, json_data: dict, etag: str = None) -> httpx.Response:
+        """POST to the context manager and check the response for errors
+
+        With etag, the request is conditional on the content having changed.
+        """
+        # Only movePositions goes through here, which is safe to retry
+        headers = {'If-None-Match': etag} if etag is not None else None
+        request = self._request(params, json_data, headers)
+        for attempt in range(RETRIES + 1):
+            response = self.session.post(self.url, **request)
+            if response.status_code not in RETRY_STATUSES or attempt == RETRIES:
+                break
+            time.sleep(BACKOFF_FACTOR * 2 ** attempt)
+        # An unchanged answer to a conditional fetch is handled by the caller
+        if not (etag is not None and response.status_code in NOT_MODIFIED_STATUSES):
+            is_error(response)
+        return response
+
+    def _post(self, params: dict, json_data: dict) -> list:
+        """POST to the context manager and return the updated option list"""
+        return _values(self._send(params, json_data))
+
+    async def _post_async(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                          params: dict, json_data: dict) -> list:
+        """POST on the shared async client and return the updated option list"""
+        async with sem:
+            response = await http.post(self.url, **self._request(params, json_data))
+        is_error(response)
+        return _values(response)
+
+    def get_options(self) -> list:
+        """Retrieve list of existing field options from JIRA and refresh the cache"""
+        json_data = {
+            'customFieldId': self.field_id,
+            'positions': {},
+        }
+        stored = self.cache.read_stored()
+        etag = stored['etag'] if stored else None
+        response = self._send(self._params('movePositions'), json_data, etag=etag)
+        if stored and response.status_code in NOT_MODIFIED_STATUSES:
+            logger.debug("Option list unchanged since last run, using cached copy")
+            values = stored['values']
+        else:
+            values = _values(response)
+            served_etag = response.headers.get('ETag')
+            if served_etag and not self.dry_run:
+                self.cache.store(served_etag, values)
+        self.cache.load(values)
+        return values
+
+    def get_option(self, value: str):
+        """Retrieve cached field with name value"""
+        return self.cache.get(value)
+
+    def get_option_id(self, value: str):
+        """Retrieve id of cached field with name value"""
+        return self.cache.by_value.get(value)
+
+    async def disable_option(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                             option_id: str) -> list:
+        """Disable a field by id"""
+        # isDisabled is inverted in the API...
+        json_data = {
+            'customFieldId': self.field_id,
+            'isDisabled': False,
+            'optionId': option_id,
+        }
+        logger.debug("Disabling %s", option_id)
+        if self.dry_run:
+            return None
+        return await self._post_async(http, sem, self._params('updateEnabled'), json_data)
+
+    async def enable_option(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                            option_id: str) -> list:
+        """Enable a field by id"""
+        # isDisabled is inverted in the API...
+        json_data = {
+            'customFieldId': self.field_id,
+            'isDisabled': True,
+            'optionId': option_id,
+        }
+        logger.debug("Enabling %s", option_id)
+        if self.dry_run:
+            return None
+        return await self._post_async(http, sem, self._params('updateEnabled'), json_data)
+
+    async def add_option(self, http: httpx.AsyncClient, sem: asyncio.Semaphore,
+                         value: str, position: str) -> list:
+        """Add new field option to JIRA"""
+        json_data = {
+            'customFieldId': self.field_id,
+            'value': value,
+            'position': position
+        }
+        logger.info("Adding %s to position %s", value, position)
+        if self.dry_run:
+            return None
+        return await self._post_async(http, sem, self._params('addOption'), json_data)
+
+    def move_option(self, positions: dict) -> list:
+        """Reorder field options by position dictionary"""
+        json_data = {
+            'customFieldId': self.field_id,
+            'positions': positions,
+        }
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Reordering positions: %s", positions)
+        if self.dry_run:
+            return None
+        return self._post(self._params('movePositions'), json_data)
+
+    async def _apply(self, disable_ids: list, enable_ids: list, additions: list) -> list:
+        """Issue all writes as one concurrent batch, returning the addOption results"""
+        sem = asyncio.Semaphore(MAX_CONCURRENT_WRITES)
+        async with self.async_session_factory() as http:
+            _, _, added = await asyncio.gather(
+                asyncio.gather(*[self.disable_option(http, sem, opt_id) for opt_id in disable_ids]),
+                asyncio.gather(*[self.enable_option(http, sem, opt_id) for opt_id in enable_ids]),
+                asyncio.gather(*[self.add_option(http, sem, opt, str(idx))
+                                 for idx, opt in enumerate(additions)]))
+        return added
+
+    # pylint: disable=too-many-locals
+    def sync(self, desired: list, static: list, desired_set: set = None):
+        """Make the field options match desired, sorted with static options at the end
+
+        desired_set may be passed when the caller already holds the options as a
+        set, to avoid hashing them again.
+        """
+        self.get_options()
+        file_options = desired_set if desired_set is not None else set(desired)
+
+        # The option name lists below are only built for logging
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Current options: %s", [x.get('value') for x in self.cache.values])
+            logger.info("Current enabled options: %s",
+                        [x.get('value') for x in self.cache.values if not x['disabled']])
+            logger.info("New options: %s", file_options)
+
+        # Disabled options already known to JIRA are re-enabled rather than added again
+        only_jira, additions = diff_sorted(sorted(self.cache.by_value), sorted(file_options))
+
+        missing = [opt for opt in only_jira if not self.get_option(opt)['disabled']]
+        logger.info("Removals: %s", missing)
+
+        logger.info("Additions: %s", additions)
+
+        # Disable options from missing
+        disable_ids = [self.get_option_id(opt) for opt in missing]
+        if logger.isEnabledFor(logging.INFO):
+            for opt, opt_id in zip(missing, disable_ids):
+                logger.info("Disabling option: %s", {'name': opt, 'id': opt_id})
+
+        # Enable all options in source of truth list
+        enable_ids = []
+        for opt in desired:
+            opt_config = self.get_option(opt)
+            if opt_config and opt_config['disabled']:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Enabling option: %s",
+                                {'name': opt_config['value'], 'id': opt_config['optionId']})
+                enable_ids.append(opt_config['optionId'])
+
+        # Every write depends only on the initial option list, so disables, enables and
+        # additions are issued as a single concurrent batch
+        added = asyncio.run(self._apply(disable_ids, enable_ids, additions))
+
+        # Apply the changes locally instead of fetching the option list again. Each
+        # addOption response carries the updated option list, which holds the new ids
+        for opt_id in disable_ids:
+            self.cache.set_disabled(opt_id, True)
+        for opt_id in enable_ids:
+            self.cache.set_disabled(opt_id, False)
+        for values in added:
+            self.cache.merge(values)
+
+        # Reorder option list in JIRA alphabetically with static options appended to the end
+        positions = order_positions(self.cache.values, static)
+
+        # Without additions the cache still holds the options in the order JIRA returned
+        if not additions:
+            current_positions = {opt['optionId']: str(idx+1)
+                                 for idx, opt in enumerate(self.cache.values)}
+            if current_positions == positions:
+                logger.info("Order already correct, skipping movePositions")
+                return
+
+        self.move_option(positions)